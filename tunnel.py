@@ -3,60 +3,150 @@ Created on Sep 18, 2022
 
 @author: a_kondratenko
 '''
-from _struct import unpack, pack
 import abc
 from argparse import ArgumentParser, Action
+from collections import deque
 import datetime
 from enum import IntEnum, auto
 import hashlib
-import math
+import select
+import selectors
 import socket
 import ssl
 import sys
-from threading import Thread, Lock, Condition
+from threading import Thread, Lock, Condition, Event
 import time
 
 
-class BinaryInputStream(object):
-    __metaclass__ = abc.ABCMeta
+def encodePackedUInt64(value):
+    if value < (1 << 7):
+        return bytes((value,))
+    if value < (1 << 14):
+        return bytes(((value & 0x7f) | 0x80, value >> 7))
+    data = bytearray()
+    for _ in range(0, 8):
+        if value < (1 << 7):
+            data.append(value & 0x7f)
+            return data
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value & 0xff)
+    return data
+
+def decodePackedUInt64(data, pos, end):
+    if pos < end and data[pos] < (1 << 7):
+        return data[pos], pos + 1
+    if pos + 1 < end and data[pos + 1] < (1 << 7):
+        return (data[pos] & 0x7f) | (data[pos + 1] << 7), pos + 2
+    start = pos
+    limit = min(end, start + 8)
+    while pos < limit and data[pos] & 0x80:
+        pos += 1
+    if pos < limit:
+        size = pos - start + 1
+    elif pos == start + 8 and pos < end:
+        size = 9
+    else:
+        return None
+    value = int.from_bytes(data[start:start + min(size, 8)], "little")
+    value = (value & 0x007f007f007f007f) | ((value & 0x7f007f007f007f00) >> 1)
+    value = (value & 0x00003fff00003fff) | ((value & 0x3fff00003fff0000) >> 2)
+    value = (value & 0x000000000fffffff) | ((value & 0x0fffffff00000000) >> 4)
+    if size == 9:
+        value |= data[start + 8] << 56
+    return value, start + size
+
+class BinaryInputStream(metaclass=abc.ABCMeta):
+    __slots__ = ("__data", "__view", "__start", "__end", "__large")
+    __BUF_SIZE = 64*1024
+    __RECORD_SIZE = 16*1024
+    __LARGE_BUF_LIMIT = 16*1024*1024
+    def __init__(self):
+        self.__data = bytearray(BinaryInputStream.__BUF_SIZE)
+        self.__view = memoryview(self.__data)
+        self.__start = 0
+        self.__end = 0
+        self.__large = memoryview(bytearray())
     @abc.abstractmethod
-    def read(self, size):
+    def readinto(self, view):
         raise NotImplementedError("BinaryInputStream is abstract")
+    def __receive(self, view):
+        read = self.readinto(view)
+        if not read:
+            raise Exception("Socket closed")
+        return read
+    def __fill(self, size):
+        while self.__end - self.__start < size:
+            if self.__start > 0 and (self.__start == self.__end or
+                    len(self.__data) - self.__end < BinaryInputStream.__RECORD_SIZE or
+                    self.__start + size > len(self.__data)):
+                available = self.__end - self.__start
+                self.__view[:available] = self.__view[self.__start:self.__end]
+                self.__start = 0
+                self.__end = available
+            self.__end += self.__receive(self.__view[self.__end:])
+    def read(self, size):
+        if size > len(self.__data) - BinaryInputStream.__RECORD_SIZE and size > self.__end - self.__start:
+            limit = BinaryInputStream.__LARGE_BUF_LIMIT
+            if len(self.__large) < size <= limit:
+                self.__large = memoryview(bytearray(max(size, min(2*len(self.__large), limit))))
+            if size <= len(self.__large):
+                view = self.__large[:size]
+            else:
+                view = memoryview(bytearray(size))
+            read = self.__end - self.__start
+            view[:read] = self.__view[self.__start:self.__end]
+            self.__start = 0
+            self.__end = 0
+            while read < size:
+                read += self.__receive(view[read:])
+            return view
+        self.__fill(size)
+        start = self.__start
+        self.__start += size
+        return self.__view[start:self.__start]
     def readUInt8(self):
-        return unpack("<B", self.read(1))[0]
+        return self.read(1)[0]
     def readPackedUInt64(self):
-        result = 0
-        offset = 0
-        for _ in range(0, 8):
-            value8 = self.readUInt8()
-            result |= (value8 & 0x7f) << offset
-            if value8 & 0x80 == 0:
-                return result
-            offset += 7
-        value8 = self.readUInt8()
-        result |= value8 << offset
-        return result
+        if self.__start == self.__end:
+            self.__fill(1)
+        value = self.__data[self.__start]
+        if value < (1 << 7):
+            self.__start += 1
+            return value
+        while True:
+            decoded = decodePackedUInt64(self.__data, self.__start, self.__end)
+            if decoded:
+                value, self.__start = decoded
+                return value
+            self.__fill(self.__end - self.__start + 1)
+    def readPackedUInt64s(self, count):
+        values = []
+        while len(values) < count:
+            decoded = decodePackedUInt64(self.__data, self.__start, self.__end)
+            if decoded:
+                value, self.__start = decoded
+                values.append(value)
+            else:
+                self.__fill(self.__end - self.__start + 1)
+        return values
     def readString(self):
         size = self.readPackedUInt64()
         if size > 0:
-            return bytes(self.read(size)).decode("utf-8")
+            return str(self.read(size), "utf-8")
         return ""
 
-class BinaryOutputStream(object):
-    __metaclass__ = abc.ABCMeta
+class BinaryOutputStream(metaclass=abc.ABCMeta):
+    __slots__ = ()
     @abc.abstractmethod
     def write(self, data):
         raise NotImplementedError("BinaryOutputStream is abstract")
     def writeUInt8(self, value):
-        self.write(pack("<B", value))
+        self.write(bytes((value & 0xff,)))
     def writePackedUInt64(self, value):
-        for _ in range(0, 8):
-            if value < (1 << 7):
-                self.writeUInt8(value & 0x7f)
-                return
-            self.writeUInt8((value & 0x7f) | 0x80)
-            value >>= 7
-        self.writeUInt8(value & 0xff)
+        self.write(encodePackedUInt64(value))
+    def writeMessage(self, message):
+        self.write(MESSAGE_TAGS[message])
     def writeString(self, value):
         data = value.encode("utf-8")
         size = len(data)
@@ -65,32 +155,32 @@ class BinaryOutputStream(object):
             self.write(data)
 
 class MemoryOutputStream(BinaryOutputStream):
-    __ALIGNMENT = 1024
+    __slots__ = ("__data",)
     def __init__(self):
-        self.__data = bytearray(MemoryOutputStream.__ALIGNMENT)
-        self.__view = memoryview(self.__data)
-        self.__pos = 0
+        self.__data = bytearray()
     def write(self, data):
-        size = len(data)
-        if self.__pos + size > len(self.__data):
-            newSize = math.floor((self.__pos + size - 1)/MemoryOutputStream.__ALIGNMENT + 1)*MemoryOutputStream.__ALIGNMENT
-            view = self.__view
-            self.__data = bytearray(newSize)
-            self.__view = memoryview(self.__data)
-            self.__view[:self.__pos] = view[:self.__pos]
-        self.__view[self.__pos:self.__pos + size] = data
-        self.__pos += size
+        self.__data += data
+    def writeUInt8(self, value):
+        self.__data.append(value & 0xff)
+    def writePackedUInt64(self, value):
+        if value < (1 << 7):
+            self.__data.append(value)
+            return
+        self.__data += encodePackedUInt64(value)
+    def writeMessage(self, message):
+        self.__data += MESSAGE_TAGS[message]
     @property
     def data(self):
-        return self.__view[:self.__pos]
+        return memoryview(self.__data)
     def reset(self):
-        self.__pos = 0
+        del self.__data[:]
 
 class Logger(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.__condition = Condition()
         self.__entries = []
+        self.verbose = False
     def log(self, message):
         with self.__condition:
             self.__entries.append((datetime.datetime.now(), message))
@@ -113,22 +203,18 @@ class Logger(Thread):
 logger = Logger()
 logger.start()
 
+def tuneSocket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
 class StreamConnection(BinaryInputStream, BinaryOutputStream):
-    __ALIGNMENT = 1024
+    __slots__ = ("__sock", "__lock")
     def __init__(self, sock):
+        BinaryInputStream.__init__(self)
         self.__sock = sock
         self.__lock = Lock()
-        self.__data = bytearray(StreamConnection.__ALIGNMENT)
-        self.__view = memoryview(self.__data)
-    def read(self, size):
-        if size > len(self.__data):
-            newSize = math.floor((size - 1)/StreamConnection.__ALIGNMENT + 1)*StreamConnection.__ALIGNMENT
-            self.__data = bytearray(newSize)
-            self.__view = memoryview(self.__data)
-        read = 0
-        while read < size:
-            read += self.__sock.recv_into(self.__view[read:], size - read)
-        return self.__view[:read]
+    def readinto(self, view):
+        return self.__sock.recv_into(view)
     def write(self, data, description = None):
         self.__lock.acquire()
         try:
@@ -142,8 +228,9 @@ class StreamConnection(BinaryInputStream, BinaryOutputStream):
         self.__sock.close()
 
 class ServerConnection(StreamConnection):
+    __slots__ = ()
     def __init__(self, context, port, reconnect):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        sock = tuneSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0))
         try:
             sock.bind(("0.0.0.0", port))
         except:
@@ -152,13 +239,14 @@ class ServerConnection(StreamConnection):
             raise
         sock.listen()
         conn, addr = sock.accept()
-        wrapped = context.wrap_socket(conn, server_side=True)
+        wrapped = context.wrap_socket(tuneSocket(conn), server_side=True)
         StreamConnection.__init__(self, wrapped)
 
 class ClientConnection(StreamConnection):
+    __slots__ = ()
     def __init__(self, context, host, port):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        wrapped = context.wrap_socket(sock)
+        wrapped = context.wrap_socket(tuneSocket(sock))
         wrapped.connect((host, port))
         StreamConnection.__init__(self, wrapped)
 
@@ -170,80 +258,156 @@ class Message(IntEnum):
     Data = auto()
     KeepAlive = auto()
 
+MESSAGE_TAGS = {message: bytes(encodePackedUInt64(message)) for message in Message}
+
 class KeepAlive(Thread):
     def __init__(self, connection, period):
         Thread.__init__(self)
         self.__connection = connection
         self.__period = period
+        self.__stopped = Event()
+    def run(self):
+        while not self.__stopped.wait(self.__period):
+            try:
+                self.__connection.write(MESSAGE_TAGS[Message.KeepAlive])
+            except:
+                break
+        self.__connection.close()
+    def close(self):
+        self.__stopped.set()
+        self.join()
+
+class TunnelReactor(Thread):
+    __BUF_SIZE = 1024*1024
+    __SELECT_LIMIT = 512
+    def __init__(self):
+        Thread.__init__(self)
+        self.__selector = selectors.DefaultSelector()
         self.__lock = Lock()
-        self.__running = True
-        self.__stream = MemoryOutputStream()
-        self.__stream.writePackedUInt64(Message.KeepAlive)
-    def __isrunning(self):
+        self.__pending = []
+        self.__wakeup, self.__notify = socket.socketpair()
+        self.__notify.setblocking(False)
+        self.__selector.register(self.__wakeup, selectors.EVENT_READ)
+    def __post(self, sock, callback, abort):
         self.__lock.acquire()
-        running = self.__running
+        self.__pending.append((sock, callback, abort))
         self.__lock.release()
-        return running
+        try:
+            self.__notify.send(b"\0")
+        except BlockingIOError:
+            pass
+    def __update(self):
+        self.__wakeup.recv(4096)
+        self.__lock.acquire()
+        pending = self.__pending
+        self.__pending = []
+        self.__lock.release()
+        for sock, callback, abort in pending:
+            if callback:
+                self.__add(sock, callback, abort)
+            else:
+                self.__drop(sock)
+    def __add(self, sock, callback, abort):
+        try:
+            if isinstance(self.__selector, selectors.SelectSelector) and \
+                    len(self.__selector.get_map()) >= TunnelReactor.__SELECT_LIMIT:
+                raise ValueError("Too many sockets for select()")
+            self.__selector.register(sock, selectors.EVENT_READ, (callback, abort))
+        except (ValueError, OSError) as e:
+            logger.log(f"Unable to watch socket: {e}")
+            self.__abort(sock, abort)
+    def __abort(self, sock, abort):
+        self.__drop(sock)
+        try:
+            abort()
+        except:
+            pass
+    def __sweep(self):
+        for key in list(self.__selector.get_map().values()):
+            if key.fileobj is self.__wakeup:
+                continue
+            try:
+                select.select([key.fileobj], [], [], 0)
+            except (ValueError, OSError):
+                self.__abort(key.fileobj, key.data[1])
+    def __drop(self, sock):
+        try:
+            self.__selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+    def register(self, sock, callback, abort):
+        self.__post(sock, callback, abort)
+    def unregister(self, sock):
+        self.__post(sock, None, None)
     def run(self):
-        while self.__isrunning():
-            start = time.time()
-            while self.__isrunning() and time.time() - start < self.__period:
-                time.sleep(1)
-            if self.__isrunning():
+        data = bytearray(TunnelReactor.__BUF_SIZE)
+        view = memoryview(data)
+        while True:
+            try:
+                events = self.__selector.select()
+            except (ValueError, OSError) as e:
+                logger.log(f"select() failed: {e}")
+                self.__sweep()
+                continue
+            for key, _ in events:
+                if key.fileobj is self.__wakeup:
+                    self.__update()
+                    continue
+                callback, abort = key.data
                 try:
-                    self.__connection.write(self.__stream.data)
+                    if not callback(view):
+                        self.__drop(key.fileobj)
                 except:
-                    self.__lock.acquire()
-                    self.__running = False
-                    self.__lock.release()
-        self.__connection.close()
-    def close(self):
-        self.__lock.acquire()
-        self.__running = False
-        self.__lock.release()
-        self.join()
+                    self.__abort(key.fileobj, abort)
 
-class TunnelConnection(Thread):
-    __BUF_SIZE = 16*1024*1024
+reactor = TunnelReactor()
+reactor.start()
+
+class TunnelConnection(object):
+    __slots__ = ("__connections", "__cid", "__sock", "__prefix", "__closed")
+    __HEADER_SIZE = 32
     def __init__(self, connections, cid, sock):
-        Thread.__init__(self)
         self.__connections = connections
         self.__cid = cid
         self.__sock = sock
+        self.__prefix = MESSAGE_TAGS[Message.Data] + encodePackedUInt64(cid)
         self.__closed = False
-    def run(self):
-        stream = MemoryOutputStream()
-        data = bytearray(TunnelConnection.__BUF_SIZE)
-        view = memoryview(data)
-        while True:
-            try:
-                read = self.__sock.recv_into(view)
-                if not read:
-                    raise Exception("Socket closed")
-                stream.writePackedUInt64(Message.Data)
-                stream.writePackedUInt64(self.__cid)
-                stream.writePackedUInt64(read)
-                stream.write(view[:read])
-                self.__connections.write(stream.data, f"send({self.__cid}, {read})")
-                stream.reset()
-            except:
-                break
+    def __receive(self, view):
+        end = TunnelConnection.__HEADER_SIZE
+        try:
+            read = self.__sock.recv_into(view[end:])
+            if not read:
+                raise Exception("Socket closed")
+            header = self.__prefix + encodePackedUInt64(read)
+            start = end - len(header)
+            view[start:end] = header
+            description = f"send({self.__cid}, {read})" if logger.verbose else None
+            self.__connections.write(view[start:end + read], description)
+            return True
+        except:
+            pass
+        self.__disconnect()
+        return False
+    def __disconnect(self):
         if not self.__closed:
             logger.log(f"disconnect({self.__cid})")
-            stream.writePackedUInt64(Message.Close)
-            stream.writePackedUInt64(self.__cid)
-            self.__connections.write(stream.data)
-            stream.reset()
+            self.__connections.write(MESSAGE_TAGS[Message.Close] + encodePackedUInt64(self.__cid))
             self.__connections.remove(self.__cid)
+    def start(self):
+        reactor.register(self.__sock, self.__receive, self.__disconnect)
     def send(self, data):
         self.__sock.sendall(data)
     def close(self):
         self.__closed = True
-        self.__sock.shutdown(socket.SHUT_RDWR)
-        self.__sock.close()
-        self.join()
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        reactor.unregister(self.__sock)
 
 class Cid(object):
+    __slots__ = ("__cid", "__active", "__time")
     __COOLDOWN_TIME = 60
     def __init__(self, cid):
         self.__cid = cid
@@ -251,6 +415,8 @@ class Cid(object):
         self.__time = time.time()
     def cid(self):
         return self.__cid
+    def active(self):
+        return self.__active
     def activate(self):
         self.__active = True
         self.__time = time.time()
@@ -270,60 +436,66 @@ class TunnelConnections(object):
         self.__server = server
         self.__connections = {}
         self.__allocated = []
-        self.__cids = []
+        self.__released = deque()
+        self.__cids = deque()
         self.__lock = Lock()
         self.__condition = Condition()
-        self.__stream = MemoryOutputStream()
-    def __ready(self):
-        for item in self.__allocated:
-            if item.ready():
-                return item
-        return None
+        self.__closed = False
     def allocate(self):
         if self.__server:
             self.__lock.acquire()
-            ready = self.__ready()
-            if not ready:
+            if self.__closed:
+                self.__lock.release()
+                raise Exception("Tunnel closed")
+            if len(self.__released) > 0 and self.__released[0].ready():
+                ready = self.__released.popleft()
+            else:
                 ready = Cid(len(self.__allocated))
                 self.__allocated.append(ready)
             ready.activate()
             cid = ready.cid()
             self.__lock.release()
         else:
-            self.__lock.acquire()
-            self.__stream.writePackedUInt64(Message.Allocate)
-            self.__connection.write(self.__stream.data)
-            self.__stream.reset()
-            self.__lock.release()
+            self.__connection.write(MESSAGE_TAGS[Message.Allocate])
             with self.__condition:
-                while len(self.__cids) == 0:
+                while len(self.__cids) == 0 and not self.__closed:
                     self.__condition.wait()
-                cid = self.__cids.pop(0)
+                if self.__closed:
+                    raise Exception("Tunnel closed")
+                cid = self.__cids.popleft()
         return cid
     def create(self, cid, sock):
         connection = TunnelConnection(self, cid, sock)
         self.__lock.acquire()
-        self.__connections[cid] = connection
+        closed = self.__closed
+        if not closed:
+            self.__connections[cid] = connection
         self.__lock.release()
+        if closed:
+            sock.close()
+            raise Exception("Tunnel closed")
     def start(self, cid):
         self.__lock.acquire()
         connection = self.__connections[cid]
         self.__lock.release()
         connection.start()
+    def __release(self, cid):
+        if self.__server:
+            allocated = self.__allocated[cid]
+            if allocated.active():
+                allocated.deactivate()
+                self.__released.append(allocated)
     def close(self, cid):
-        connection = None
         self.__lock.acquire()
-        if cid in self.__connections:
-            connection = self.__connections[cid]
+        connection = self.__connections.pop(cid, None)
+        self.__release(cid)
         self.__lock.release()
         if connection:
             connection.close()
     def remove(self, cid):
         self.__lock.acquire()
-        if cid in self.__connections:
-            del self.__connections[cid]
-        if self.__server:
-            self.__allocated[cid].deactivate()
+        self.__connections.pop(cid, None)
+        self.__release(cid)
         self.__lock.release()
     def cid(self, cid):
         with self.__condition:
@@ -332,14 +504,15 @@ class TunnelConnections(object):
     def write(self, data, description = None):
         self.__connection.write(data, description)
     def send(self, cid, data):
-        connection = None
         self.__lock.acquire()
-        if cid in self.__connections:
-            connection = self.__connections[cid]
+        connection = self.__connections.get(cid)
         self.__lock.release()
         if connection:
             connection.send(data)
     def closeall(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
         self.__lock.acquire()
         connections = self.__connections
         self.__connections = {}
@@ -348,28 +521,27 @@ class TunnelConnections(object):
             connection.close()
 
 class TunnelPort(Thread):
+    __ACCEPTORS = 4
     def __init__(self, connections, port, mapped):
         Thread.__init__(self)
         self.__connections = connections
         self.__port = port
         self.__mapped = mapped
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    def run(self):
+        self.__sock = tuneSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        self.__acceptors = []
+    def __accept(self):
         try:
-            try:
-                self.__sock.bind(("0.0.0.0", self.__mapped))
-            except:
-                logger.log(f"Port {self.__mapped} already in use")
-                raise
-            self.__sock.listen()
-            logger.log(f"listen({self.__mapped}) --> {self.__port}")
             stream = MemoryOutputStream()
             while True:
                 conn, addr = self.__sock.accept()
-                cid = self.__connections.allocate()
+                try:
+                    cid = self.__connections.allocate()
+                except:
+                    conn.close()
+                    raise
                 logger.log(f"local connection {addr}")
-                self.__connections.create(cid, conn)
-                stream.writePackedUInt64(Message.Connect)
+                self.__connections.create(cid, tuneSocket(conn))
+                stream.writeMessage(Message.Connect)
                 stream.writePackedUInt64(cid)
                 stream.writePackedUInt64(self.__port)
                 self.__connections.write(stream.data)
@@ -377,9 +549,92 @@ class TunnelPort(Thread):
                 self.__connections.start(cid)
         except:
             pass
+    def run(self):
+        try:
+            self.__sock.bind(("0.0.0.0", self.__mapped))
+        except:
+            logger.log(f"Port {self.__mapped} already in use")
+            return
+        self.__sock.listen()
+        logger.log(f"listen({self.__mapped}) --> {self.__port}")
+        for _ in range(TunnelPort.__ACCEPTORS - 1):
+            acceptor = Thread(target=self.__accept)
+            self.__acceptors.append(acceptor)
+            acceptor.start()
+        self.__accept()
     def close(self):
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.__sock.close()
         self.join()
+        for acceptor in self.__acceptors:
+            acceptor.join()
+
+class TunnelDispatcher(object):
+    def __init__(self, connection, connections, target, forward):
+        self.__connection = connection
+        self.__connections = connections
+        self.__target = target
+        self.__forward = forward
+        self.__stream = MemoryOutputStream()
+        self.__handlers = {
+            int(Message.Allocate): self.__allocate,
+            int(Message.Cid): self.__cid,
+            int(Message.Connect): self.__connect,
+            int(Message.Close): self.__close,
+            int(Message.Data): self.__data,
+            int(Message.KeepAlive): self.__keepalive,
+        }
+    def dispatch(self, msg):
+        handler = self.__handlers.get(msg)
+        if handler is None:
+            raise Exception(f"Unknown msg {msg}")
+        handler()
+    def __allocate(self):
+        cid = self.__connections.allocate()
+        logger.log(f"allocate --> {cid}")
+        stream = self.__stream
+        stream.writeMessage(Message.Cid)
+        stream.writePackedUInt64(cid)
+        self.__connection.write(stream.data)
+        stream.reset()
+    def __cid(self):
+        cid = self.__connection.readPackedUInt64()
+        logger.log(f"cid({cid})")
+        self.__connections.cid(cid)
+    def __connect(self):
+        cid, port = self.__connection.readPackedUInt64s(2)
+        logger.log(f"connect({cid}, {port})")
+        try:
+            if port not in self.__forward:
+                logger.log(f"Port {port} is not allowed to connect")
+                raise Exception(f"Port {port} is not allowed to connect")
+            sock = tuneSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            sock.connect((self.__target, port))
+            self.__connections.create(cid, sock)
+            self.__connections.start(cid)
+        except:
+            logger.log(f"abort({cid})")
+            stream = self.__stream
+            stream.writeMessage(Message.Close)
+            stream.writePackedUInt64(cid)
+            self.__connection.write(stream.data)
+            stream.reset()
+            self.__connections.remove(cid)
+    def __close(self):
+        cid = self.__connection.readPackedUInt64()
+        logger.log(f"close({cid})")
+        self.__connections.close(cid)
+    def __data(self):
+        cid, size = self.__connection.readPackedUInt64s(2)
+        data = self.__connection.read(size)
+        if logger.verbose:
+            logger.log(f"recv({cid}, {size})")
+        self.__connections.send(cid, data)
+    def __keepalive(self):
+        logger.log("keepalive()")
 
 class MappingAction(Action):
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
@@ -415,6 +670,7 @@ if __name__ == '__main__':
     server.add_argument("--mapping", action=MappingAction, help="ports mapping to connect to", nargs='+', default={})
     server.add_argument("--cert", help="path to the certificate in PEM format, default is tunnel.crt", default="tunnel.crt")
     server.add_argument("--key", help="path to the private key in PEM format, default is tunnel.key", default="tunnel.key")
+    server.add_argument("--verbose", help="log every forwarded data frame", action="store_true")
     client = subparsers.add_parser("client")
     client.add_argument("host", help="host of the server to connect to")
     client.add_argument("port", help="port of the server to connect to", type=int)
@@ -424,8 +680,17 @@ if __name__ == '__main__':
     client.add_argument("--keepalive", help="period to send keepalive messages, in seconds, default is 60", type=int, default=60)
     client.add_argument("--mapping", action=MappingAction, help="ports mapping to connect to", nargs='+', default={})
     client.add_argument("--cert", help="path to the certificate in PEM format, default is tunnel.crt", default="tunnel.crt")
+    client.add_argument("--verbose", help="log every forwarded data frame", action="store_true")
     args = parser.parse_args()
+    logger.verbose = args.verbose
     digest = hashlib.sha256(open(__file__).read().encode("utf-8")).digest()
+    stream = MemoryOutputStream()
+    stream.writePackedUInt64(len(digest))
+    stream.write(digest)
+    stream.writePackedUInt64(len(args.forward))
+    for forward in args.forward:
+        stream.writePackedUInt64(forward)
+    handshake = bytes(stream.data)
     if args.command == "server":
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         context.load_cert_chain(args.cert, args.key)
@@ -447,14 +712,7 @@ if __name__ == '__main__':
                 logger.log("client mode")
                 connection = ClientConnection(context, args.host, args.port)
             logger.log("connected")
-            stream = MemoryOutputStream()
-            stream.writePackedUInt64(len(digest))
-            stream.write(digest)
-            stream.writePackedUInt64(len(args.forward))
-            for forward in args.forward:
-                stream.writePackedUInt64(forward)
-            connection.write(stream.data)
-            stream.reset()
+            connection.write(handshake)
             size = connection.readPackedUInt64()
             rdigest = connection.read(size)
             if rdigest != digest:
@@ -471,61 +729,17 @@ if __name__ == '__main__':
                 tunnel.start()
             keepalive = KeepAlive(connection, args.keepalive)
             keepalive.start()
+            dispatcher = TunnelDispatcher(connection, connections, args.target, args.forward)
             while True:
-                msg = connection.readPackedUInt64()
-                if msg == Message.Allocate:
-                    cid = connections.allocate()
-                    logger.log(f"allocate --> {cid}")
-                    stream.writePackedUInt64(Message.Cid)
-                    stream.writePackedUInt64(cid)
-                    connection.write(stream.data)
-                    stream.reset()
-                elif msg == Message.Cid:
-                    cid = connection.readPackedUInt64()
-                    logger.log(f"cid({cid})")
-                    connections.cid(cid)
-                elif msg == Message.Connect:
-                    cid = connection.readPackedUInt64()
-                    port = connection.readPackedUInt64()
-                    logger.log(f"connect({cid}, {port})")
-                    try:
-                        if port not in args.forward:
-                            logger.log(f"Port {port} is not allowed to connect")
-                            raise Exception(f"Port {port} is not allowed to connect")
-                        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        sock.connect((args.target, port))
-                        connections.create(cid, sock)
-                        connections.start(cid)
-                    except:
-                        logger.log(f"abort({cid})")
-                        stream.writePackedUInt64(Message.Close)
-                        stream.writePackedUInt64(cid)
-                        connection.write(stream.data)
-                        stream.reset()
-                        connections.remove(cid)
-                elif msg == Message.Close:
-                    cid = connection.readPackedUInt64()
-                    logger.log(f"close({cid})")
-                    connections.close(cid)
-                    connections.remove(cid)
-                elif msg == Message.Data:
-                    cid = connection.readPackedUInt64()
-                    size = connection.readPackedUInt64()
-                    data = connection.read(size)
-                    logger.log(f"recv({cid}, {size})")
-                    connections.send(cid, data)
-                elif msg == Message.KeepAlive:
-                    logger.log("keepalive()")
-                else:
-                    raise Exception(f"Unknown msg {msg}")
+                dispatcher.dispatch(connection.readPackedUInt64())
         except:
+            if connections:
+                connections.closeall()
+                connections = None
             if ports:
                 for port in ports:
                     port.close()
                 ports = None
-            if connections:
-                connections.closeall()
-                connections = None
             if keepalive:
                 keepalive.close()
                 keepalive = None